@@ -3,8 +3,32 @@ import json
 import re
 import itertools
 import math
+import sys
 from pathlib import Path
-from typing import Dict, List, Tuple, Set
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+_SEP_RE = re.compile(r"^-{5,}")
+_WS_RE = re.compile(r"\s+")
+_NAME_PAREN_RE = re.compile(r"\(([^)]+)\)")
+_PEAK_RE = re.compile(r"^[0-9]+\.?[0-9]*\s+")
+_CLEAN_RE = re.compile(r"[^0-9_.]+$")
+_KEY_RE = re.compile(r"^[0-9.]+")
+
+
+def parse_cluster_block(block: List[str]) -> Dict:
+    """
+    Convert the stripped lines of one cluster block into a cluster entry.
+    """
+    entry = {'entries': [], 'genes': ''}
+    for line in block:
+        if line.startswith('{') and 'cluster_genes' not in line:
+            entry['entries'].append(json.loads(line))
+        elif 'cluster_genes' in line:
+            data = json.loads(line)
+            entry['genes'] = data.get('cluster_genes', '')
+    return entry
 
 
 def parse_cluster_file(path: Path) -> List[Dict]:
@@ -12,30 +36,18 @@ def parse_cluster_file(path: Path) -> List[Dict]:
     Parse the cluster file into a list of cluster entries.
     Each entry is a dict with keys: 'entries' (list of JSON dicts) and 'genes' (str).
     """
-    clusters = []
-    raw = path.read_text().splitlines()
-    sep_pattern = re.compile(r"^-{5,}")
+    parsed = []
     current = []
-    for line in raw:
-        if sep_pattern.match(line):
-            if current:
-                clusters.append(current)
-                current = []
-        elif line.strip():
-            current.append(line.strip())
+    with path.open() as f:
+        for line in f:
+            if _SEP_RE.match(line):
+                if current:
+                    parsed.append(parse_cluster_block(current))
+                    current = []
+            elif line.strip():
+                current.append(line.strip())
     if current:
-        clusters.append(current)
-
-    parsed = []
-    for block in clusters:
-        entry = {'entries': [], 'genes': ''}
-        for line in block:
-            if line.startswith('{') and 'cluster_genes' not in line:
-                entry['entries'].append(json.loads(line))
-            elif 'cluster_genes' in line:
-                data = json.loads(line)
-                entry['genes'] = data.get('cluster_genes', '')
-        parsed.append(entry)
+        parsed.append(parse_cluster_block(current))
     return parsed
 
 
@@ -44,46 +56,61 @@ def load_group_mapping(path: Path) -> Dict[str, List[str]]:
     Load central_group.txt or mz_group.txt into a mapping from cluster_metabolite -> list of pre_metabolites
     """
     mapping: Dict[str, List[str]] = {}
-    for line in path.read_text().splitlines():
-        if not line.strip():
-            continue
-        parts = re.split(r"\s+", line.strip(), maxsplit=1)
-        key = parts[0]
-        values = [v.strip() for v in parts[1].split(',')] if len(parts) > 1 else []
-        mapping[key] = values
+    with path.open() as f:
+        for line in f:
+            if not line.strip():
+                continue
+            parts = _WS_RE.split(line.strip(), maxsplit=1)
+            key = parts[0]
+            values = [v.strip() for v in parts[1].split(',')] if len(parts) > 1 else []
+            mapping[key] = values
     return mapping
 
 
+def parse_msms_entry(lines: List[str]) -> Optional[Tuple[str, List[Tuple[float, float]]]]:
+    """
+    Parse the lines of one MSP entry into (cleaned_name, list of (mz, intensity)).
+    Returns None if the entry has no usable name.
+    """
+    name_line = next((l for l in lines if l.startswith('Name:')), None)
+    if not name_line:
+        return None
+    match = _NAME_PAREN_RE.search(name_line)
+    if not match:
+        return None
+    raw = match.group(1)
+    cleaned = clean_metabolite(raw)
+    # extract numeric peak lines
+    peaks: List[Tuple[float, float]] = []
+    for l in lines:
+        if _PEAK_RE.match(l):
+            parts = l.split()
+            try:
+                mz_val = float(parts[0])
+                intensity = float(parts[1])
+                peaks.append((mz_val, intensity))
+            except (ValueError, IndexError):
+                continue
+    return cleaned, peaks
+
+
 def load_msms(path: Path) -> Dict[str, List[Tuple[float, float]]]:
     """
     Parse the MSMS.msp file into a dict mapping cleaned_name -> list of (mz, intensity)
     """
-    content = path.read_text()
-    # split entries by blank line
-    entries = re.split(r"\n\s*\n", content.strip())
     msms_data: Dict[str, List[Tuple[float, float]]] = {}
-    for entry in entries:
-        lines = entry.splitlines()
-        name_line = next((l for l in lines if l.startswith('Name:')), None)
-        if not name_line:
-            continue
-        match = re.search(r"\(([^)]+)\)", name_line)
-        if not match:
-            continue
-        raw = match.group(1)
-        cleaned = clean_metabolite(raw)
-        # extract numeric peak lines
-        peaks: List[Tuple[float, float]] = []
-        for l in lines:
-            if re.match(r"^[0-9]+\.?[0-9]*\s+", l):
-                parts = l.split()
-                try:
-                    mz_val = float(parts[0])
-                    intensity = float(parts[1])
-                    peaks.append((mz_val, intensity))
-                except (ValueError, IndexError):
-                    continue
-        msms_data[cleaned] = peaks
+    lines: List[str] = []
+    with path.open() as f:
+        # entries are separated by blank lines
+        for line in itertools.chain(f, [""]):
+            if line.strip():
+                lines.append(line.rstrip("\n"))
+                continue
+            if lines:
+                parsed = parse_msms_entry(lines)
+                if parsed:
+                    msms_data[parsed[0]] = parsed[1]
+                lines = []
     return msms_data
 
 
@@ -102,47 +129,60 @@ def clean_metabolite(s: str) -> str:
     """
     Remove any trailing letters or symbols, keeping only digits, underscores, and dots.
     """
-    return re.sub(r"[^0-9_.]+$", "", s)
+    return _CLEAN_RE.sub("", s)
 
 
 def find_pre_metabolites(node: str, central: Dict[str, List[str]], mz: Dict[str, List[str]]) -> List[str]:
-    key = re.match(r"^[0-9.]+", node)
+    key = _KEY_RE.match(node)
     key_str = key.group(0) if key else node
     if node == key_str:
         return central.get(key_str, [])
     return mz.get(key_str, [])
 
 
-def ppm_match(list1: List[float], list2: List[float], ppm: float = 20.0) -> Set[float]:
+def ppm_match(list1: np.ndarray, list2: np.ndarray, ppm: float = 20.0) -> np.ndarray:
+    """
+    Return the m/z from list1 (in list1 order) that have at least one match in list2 within given ppm tolerance.
+    list2 must be sorted in ascending order without duplicates (see np.unique).
+    """
+    a = np.asarray(list1, dtype=np.float64)
+    b = np.asarray(list2, dtype=np.float64)
+    if not len(a) or not len(b):
+        return a[:0]
+    tol = a * ppm / 1e6
+    # merge against the sorted list2: only the first mz2 above the lower bound and
+    # its neighbours (guarding against rounding at the bounds) can match
+    pos = np.searchsorted(b, a - tol)
+    mask = np.zeros(len(a), dtype=bool)
+    for offset in (-1, 0, 1):
+        idx = np.clip(pos + offset, 0, len(b) - 1)
+        mask |= np.abs(a - b[idx]) <= tol
+    return a[mask]
+
+
+def build_top_peaks(msms: Dict[str, List[Tuple[float, float]]]) -> Dict[str, np.ndarray]:
     """
-    Return set of m/z from list1 that have at least one match in list2 within given ppm tolerance.
+    Map each cleaned metabolite name to its sorted top 50% peak m/z values, ready for ppm_match.
     """
-    matches: Set[float] = set()
-    for mz1 in list1:
-        for mz2 in list2:
-            if abs(mz1 - mz2) <= mz1 * ppm / 1e6:
-                matches.add(mz1)
-                break
-    return matches
+    return {
+        met: np.unique(np.asarray(get_top_peaks(peaks), dtype=np.float64))
+        for met, peaks in msms.items()
+    }
 
 
-def find_common_fragments_ppm(cleaned_path: List[str], msms: Dict[str, List[Tuple[float, float]]]) -> List[Set[float]]:
+def find_common_fragments_ppm(cleaned_path: List[str], top_peaks_map: Dict[str, np.ndarray]) -> List[np.ndarray]:
     """
     For each sliding window of 3 cleaned metabolites, find common peaks within 20 ppm tolerance.
     """
-    # get top 50% peaks for each metabolite
-    top_peaks = []
-    for met in cleaned_path:
-        peaks = msms.get(met, [])
-        top = get_top_peaks(peaks)
-        top_peaks.append(top)
+    empty = np.empty(0, dtype=np.float64)
+    top_peaks = [top_peaks_map.get(met, empty) for met in cleaned_path]
     # sliding window of 3
     commons = []
     for i in range(len(top_peaks) - 2):
         # match between first and second
         match12 = ppm_match(top_peaks[i], top_peaks[i+1])
         # match those results with third
-        match123 = ppm_match(list(match12), top_peaks[i+2])
+        match123 = ppm_match(match12, top_peaks[i+2])
         commons.append(match123)
     return commons
 
@@ -161,27 +201,28 @@ def main():
     central_map = load_group_mapping(args.central)
     mz_map = load_group_mapping(args.mz)
     msms_data = load_msms(args.msms)
+    top_peaks_map = build_top_peaks(msms_data)
 
     for cl in clusters:
         entries = cl['entries']
         genes = cl['genes']
         metabolites = [entries[0]['source']] + [e['target'] for e in entries]
-        print(f"cluster_genes: {genes}\nshared fragment <= 20ppm")
-        print("->".join(metabolites))
+        # collect the report for this cluster and write it in one go
+        out = [f"cluster_genes: {genes}", "shared fragment <= 20ppm", "->".join(metabolites)]
         pre_lists = [find_pre_metabolites(m, central_map, mz_map) for m in metabolites]
         multi = [m for m, lst in zip(metabolites, pre_lists) if len(lst) > 1]
         if multi:
-            print(f"Note: The grouped metabolites below correspond to multiple actual metabolites with retention times: {multi}")
+            out.append(f"Note: The grouped metabolites below correspond to multiple actual metabolites with retention times: {multi}")
         # each real path combination
         for rp in itertools.product(*pre_lists):
             cleaned_rp = [clean_metabolite(m) for m in rp]
-            commons = find_common_fragments_ppm(cleaned_rp, msms_data)
-            segments = []
-            for i, com in enumerate(commons):
-                trio = cleaned_rp[i:i+3]
-                segments.append(f"{'->'.join(trio)} : {sorted(com)}")
-            print("; ".join(segments))
-        print()
+            commons = find_common_fragments_ppm(cleaned_rp, top_peaks_map)
+            out.append("; ".join([
+                "->".join(cleaned_rp[i:i+3]) + " : " + str(sorted(com.tolist()))
+                for i, com in enumerate(commons)
+            ]))
+        out.append("")
+        sys.stdout.write("\n".join(out) + "\n")
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import math
 import re
+from collections import defaultdict
+
+import numpy as np
+
+_WS_RE = re.compile(r'\s+')
+_MASS_RE = re.compile(r'([\d\.]+)([+\-][A-Za-z0-9]+)?')
 
 def load_adducts(adduct_file):
     """
@@ -13,7 +20,7 @@ def load_adducts(adduct_file):
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
-            parts = re.split(r'\s+', line)
+            parts = _WS_RE.split(line)
             adducts[parts[0]] = float(parts[1])
     return adducts
 
@@ -22,7 +29,7 @@ def neutral_mass(val, adducts):
     Convert a string like '188.0707+H' to its neutral mass using adduct corrections.
     +H means subtract the mass of H; -H means add it.
     """
-    match = re.match(r'([\d\.]+)([+\-][A-Za-z0-9]+)?', val)
+    match = _MASS_RE.match(val)
     if not match:
         raise ValueError(f"Invalid value: {val}")
     mass = float(match.group(1))
@@ -39,7 +46,7 @@ def neutral_mass(val, adducts):
     return mass
 
 def ppm_diff(m1, m2):
-    """Return the difference in ppm between two masses."""
+    """Return the difference in ppm between two masses (or arrays of masses)."""
     return abs(m1 - m2) / m1 * 1e6
 
 def parse_clusters(cluster_file):
@@ -70,7 +77,7 @@ def count_symbols(s):
 def compute_block_masses(block, adducts):
     """
     For a block, extract lines with a 'source' key, compute their neutral masses,
-    and count total '+'/'-' symbols.
+    and count total '+'/'-' symbols. Masses are returned as a (K, 2) float array.
     """
     pairs = [json.loads(line) for line in block if '"source"' in line]
     masses = []
@@ -81,30 +88,58 @@ def compute_block_masses(block, adducts):
         m2 = neutral_mass(t, adducts)
         masses.append((m1, m2))
         sym_count += count_symbols(s) + count_symbols(t)
-    return masses, sym_count
+    return np.array(masses, dtype=np.float64).reshape(-1, 2), sym_count
+
+def mass_bucket(masses, width):
+    """
+    Bucket key of a block: its pair count and the log-scaled bin of its first mass.
+    Blocks whose first masses lie within the ppm tolerance fall in the same or adjacent bins.
+    """
+    if not len(masses) or masses[0, 0] <= 0:
+        return len(masses), None
+    return len(masses), math.floor(math.log(masses[0][0]) / width)
+
+def neighbour_buckets(key):
+    """Return the bucket key itself and its adjacent bins."""
+    n, b = key
+    if b is None:
+        return [key]
+    return [(n, b - 1), (n, b), (n, b + 1)]
 
 def deduplicate(clusters, adducts, ppm_tol):
     """
     Deduplicate clusters: for each new block, compare its masses to existing unique blocks.
     If within ppm_tol on all pairs, consider redundant. Keep block with fewer symbols.
+    Only unique blocks from neighbouring mass buckets are compared.
     """
     unique = []
     unique_data = []  # list of (masses, symbol_count)
+    buckets = defaultdict(list)  # bucket key -> indices into unique
+    # a bin twice as wide (in log space) as the tolerance keeps matches in adjacent bins
+    width = max(2 * ppm_tol / 1e6, 1e-12)
     for block in clusters:
         masses, sym = compute_block_masses(block, adducts)
+        key = mass_bucket(masses, width)
+        candidates = sorted(
+            idx for nkey in neighbour_buckets(key) for idx in buckets.get(nkey, ())
+        )
         found = False
-        for idx, (umasses, usym) in enumerate(unique_data):
-            if len(masses) == len(umasses) and all(
-                ppm_diff(m1, u1) <= ppm_tol and ppm_diff(m2, u2) <= ppm_tol
-                for (m1, m2), (u1, u2) in zip(masses, umasses)
-            ):
+        if candidates:
+            # bucket keys include the pair count, so all candidates stack to (C, K, 2)
+            stacked = np.stack([unique_data[idx][0] for idx in candidates])
+            hits = np.all(ppm_diff(masses, stacked) <= ppm_tol, axis=(1, 2))
+            if hits.any():
                 found = True
+                idx = candidates[int(np.argmax(hits))]
+                umasses, usym = unique_data[idx]
                 # Keep the one with fewer '+'/'-'
                 if sym < usym:
+                    buckets[mass_bucket(umasses, width)].remove(idx)
+                    buckets[key].append(idx)
                     unique[idx] = block
                     unique_data[idx] = (masses, sym)
-                break
         if not found:
+            buckets[key].append(len(unique))
             unique.append(block)
             unique_data.append((masses, sym))
     return unique
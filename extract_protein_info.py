@@ -3,6 +3,8 @@
 import sys
 import re
 
+ID_NUMBER_RE = re.compile(r'(\d+)')
+
 def extract_and_rename_genes(gff_file, output_file):
     """
     从GFF文件中提取基因信息并按原始基因ID顺序重命名为contig_1, contig_2等
@@ -11,7 +13,12 @@ def extract_and_rename_genes(gff_file, output_file):
         gff_file: 输入的GFF文件路径
         output_file: 输出文件路径
     """
-    genes = []
+    # 按列分别保存基因信息（并行列表），避免为每个基因创建一个字典
+    contigs = []
+    starts = []
+    ends = []
+    strands = []
+    original_ids = []
     
     # 读取GFF文件
     with open(gff_file, 'r') as f:
@@ -20,18 +27,13 @@ def extract_and_rename_genes(gff_file, output_file):
             if line.startswith('#'):
                 continue
             
-            # 解析GFF行
-            fields = line.strip().split('\t')
+            # 解析GFF行（只需要前9列）
+            fields = line.strip().split('\t', 8)
             if len(fields) < 9:
                 continue
                 
             # 只处理类型为"gene"的行
             if fields[2] == 'gene':
-                contig = fields[0]  # 染色体/contig ID
-                start = int(fields[3])  # 起始位置
-                end = int(fields[4])    # 终止位置
-                strand = fields[6]      # 正负链
-                
                 # 提取原始基因ID
                 original_id = ""
                 attributes = fields[8].split(';')
@@ -40,37 +42,38 @@ def extract_and_rename_genes(gff_file, output_file):
                         original_id = attr.split('=')[1]
                         break
                 
-                # 保存基因信息
-                genes.append({
-                    'contig': contig,
-                    'start': start,
-                    'end': end,
-                    'strand': strand,
-                    'original_id': original_id
-                })
+                # 保存基因信息：染色体/contig ID、起始位置、终止位置、正负链
+                contigs.append(fields[0])
+                starts.append(int(fields[3]))
+                ends.append(int(fields[4]))
+                strands.append(fields[6])
+                original_ids.append(original_id)
     
     # 按原始基因ID排序
     # 假设原始ID格式为"MRSxxxxxx"，我们提取数字部分并按数字大小排序
-    def get_id_number(gene):
-        match = re.search(r'(\d+)', gene['original_id'])
+    def get_id_number(original_id):
+        match = ID_NUMBER_RE.search(original_id)
         if match:
             return int(match.group(1))
         return 0
     
-    genes.sort(key=get_id_number)
+    id_numbers = [get_id_number(gid) for gid in original_ids]
+    order = sorted(range(len(original_ids)), key=id_numbers.__getitem__)
     
     # 将排序后的基因写入输出文件，重命名为contig_1, contig_2等
-    with open(output_file, 'w') as out:
+    # 使用1MB缓冲区，并通过writelines批量写入
+    with open(output_file, 'w', buffering=1 << 20) as out:
         # 写入表头
         out.write("new_geneID\toriginalID\tchromosome\tstart\tend\tstrand\n")
         
         # 写入基因信息
-        for i, gene in enumerate(genes, 1):
-            new_id = f"contig_{i}"
-            out.write(f"{new_id}\t{gene['original_id']}\t{gene['contig']}\t"
-                     f"{gene['start']}\t{gene['end']}\t{gene['strand']}\n")
+        out.writelines(
+            "\t".join((f"contig_{i}", original_ids[j], contigs[j],
+                       str(starts[j]), str(ends[j]), strands[j])) + "\n"
+            for i, j in enumerate(order, 1)
+        )
     
-    print(f"共处理了 {len(genes)} 个基因，并重命名为 contig_1 至 contig_{len(genes)}")
+    print(f"共处理了 {len(order)} 个基因，并重命名为 contig_1 至 contig_{len(order)}")
     print(f"结果已保存到 {output_file}")
 
 if __name__ == "__main__":
@@ -1,11 +1,23 @@
 import argparse
+import csv
 import json
-import pandas as pd
 import ast
-from typing import List, Dict, Set, Any, Tuple, Optional
+from typing import List, Dict, Set, FrozenSet, Any, Tuple, Optional
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import itertools
 import logging
+import os
+
+try:
+    # orjson is an optional, faster drop-in for parsing network edge lines
+    from orjson import loads as json_loads, JSONDecodeError
+except ImportError:
+    from json import loads as json_loads, JSONDecodeError
+
+# (gene, prefix, numeric suffix, numbered), see parse_gene
+ParsedGene = Tuple[str, str, Optional[int], bool]
 
 # Set logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,11 +37,17 @@ def parse_network(network_file: str) -> List[List[Dict[str, Any]]]:
                         pathways.append(pathway)
                         pathway = []
                 elif line.startswith("{") and line.endswith("}"):
+                    # Edges are written as Python dict reprs; parse them as JSON and
+                    # only fall back to literal_eval for lines that are not JSON-shaped
                     try:
-                        line_dict = ast.literal_eval(line)
-                        pathway.append(line_dict)
-                    except (ValueError, SyntaxError) as e:
-                        logging.warning(f"Skipping invalid line: {line}\nError: {e}")
+                        line_dict = json_loads(line.replace("'", '"'))
+                    except JSONDecodeError:
+                        try:
+                            line_dict = ast.literal_eval(line)
+                        except (ValueError, SyntaxError) as e:
+                            logging.warning(f"Skipping invalid line: {line}\nError: {e}")
+                            continue
+                    pathway.append(line_dict)
             if pathway:
                 pathways.append(pathway)
     except FileNotFoundError:
@@ -43,14 +61,46 @@ def parse_network(network_file: str) -> List[List[Dict[str, Any]]]:
     return pathways
 
 
+# Cells that pandas.read_csv reads as NaN by default; rows with these are skipped
+_NA_VALUES = frozenset({
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+})
+
+
 def load_reaction_mapping(reaction_file: str) -> Dict[str, List[str]]:
     """
     Load reaction to Orthology (K numbers) mapping from a tab-separated file.
     Now supports duplicate ENTRY rows by appending K numbers.
     """
-    reaction_to_k: Dict[str, List[str]] = defaultdict(list)
+    # Ordered dicts act as insertion-ordered sets, de-duplicating K numbers as they are read
+    reaction_to_k: Dict[str, Dict[str, None]] = defaultdict(dict)
     try:
-        reaction_df = pd.read_csv(reaction_file, sep="\t", dtype=str)
+        with open(reaction_file, 'r', encoding='utf-8', newline='') as file:
+            # Like pandas, skip blank lines (empty, or only whitespace without a tab)
+            reader = (row for row in csv.reader(file, delimiter='\t')
+                      if len(row) > 1 or (row and row[0].strip()))
+            header = next(reader)
+            entry_col = header.index("ENTRY") if "ENTRY" in header else None
+            orthology_col = header.index("Orthology") if "Orthology" in header else None
+            if entry_col is None:
+                # Without an ENTRY column no row can be mapped, giving an empty mapping
+                reader = iter(())
+            for row in reader:
+                entry = row[entry_col] if len(row) > entry_col else ''
+                if orthology_col is None:
+                    # Without an Orthology column every entry is kept with no K numbers
+                    orthology = ''
+                elif len(row) > orthology_col and row[orthology_col] not in _NA_VALUES:
+                    orthology = row[orthology_col]
+                else:
+                    continue
+                if entry in _NA_VALUES:
+                    continue
+                ks = reaction_to_k[entry]
+                for k in map(str.strip, orthology.split(",")):
+                    if k:
+                        ks[k] = None
     except FileNotFoundError:
         logging.error(f"Reaction mapping file not found: {reaction_file}")
         exit(1)
@@ -58,18 +108,8 @@ def load_reaction_mapping(reaction_file: str) -> Dict[str, List[str]]:
         logging.error(f"Error reading reaction mapping file: {e}")
         exit(1)
 
-    for _, row in reaction_df.iterrows():
-        entry = row.get("ENTRY")
-        orthology = row.get("Orthology") or ''
-        if pd.notnull(entry) and pd.notnull(orthology):
-            ks = [k.strip() for k in orthology.split(",") if k.strip()]
-            reaction_to_k[entry].extend(ks)
-
-    for entry, ks in reaction_to_k.items():
-        reaction_to_k[entry] = list(dict.fromkeys(ks))
-
     logging.info(f"Loaded reaction to K mapping for {len(reaction_to_k)} entries.")
-    return dict(reaction_to_k)
+    return {entry: list(ks) for entry, ks in reaction_to_k.items()}
 
 
 def load_k_to_gene_mapping(kegg_file: str) -> Tuple[Dict[str, Set[str]], Dict[str, str]]:
@@ -83,9 +123,11 @@ def load_k_to_gene_mapping(kegg_file: str) -> Tuple[Dict[str, Set[str]], Dict[st
     try:
         with open(kegg_file, 'r', encoding='utf-8') as file:
             for line in file:
-                parts = line.strip().split('\t')
-                if len(parts) >= 3:
-                    gene, k_number, annotation = parts[0].strip(), parts[1].strip(), parts[-1].strip()
+                # Only the first two columns and the last one are used; leave the rest unsplit
+                parts = line.strip().split('\t', 2)
+                if len(parts) == 3:
+                    gene, k_number = parts[0].strip(), parts[1].strip()
+                    annotation = parts[2].rpartition('\t')[2].strip()
                     gene_annotations[gene] = annotation
                     if k_number.startswith("K"):
                         k_to_gene[k_number].add(gene)
@@ -121,119 +163,105 @@ def load_gene_list(gene_list_file: str) -> Set[str]:
 def validate_cluster(
     cluster: List[str],
     differential_count: int,
-    cluster_edges: Set[int],
+    cluster_edges: int,
     total_edges: int
 ) -> Optional[Dict[str, Any]]:
     """
     Validate a cluster based on size, differential genes, and full coverage of edges.
+    cluster_edges is the bitmask of edges covered by the cluster. The counts are
+    computed by the caller, and the cluster list is kept as is in the result.
     """
     size = len(cluster)
-    covered = len(cluster_edges) == total_edges
+    covered = cluster_edges == (1 << total_edges) - 1
     if 2 <= size <= 3 and differential_count >= 1 and covered:
-        return {"genes": cluster.copy()}
+        return {"genes": cluster}
     if size > 3 and differential_count >= 2 and covered:
-        return {"genes": cluster.copy()}
+        return {"genes": cluster}
     return None
 
 
-def expand_cluster_with_gaps(cluster_genes: List[str]) -> List[str]:
-    """
-    Expand a cluster by filling in any missing numeric suffix genes between the
-    minimum and maximum suffix for the same prefix.
-    """
-    if not cluster_genes:
-        return []
-    prefixes = []
-    suffixes = []
-    for gene in cluster_genes:
-        if "_" in gene:
-            prefix, suffix_str = gene.rsplit("_", 1)
-            try:
-                suffix = int(suffix_str)
-            except ValueError:
-                continue
-            prefixes.append(prefix)
-            suffixes.append(suffix)
-    if not suffixes:
-        return cluster_genes.copy()
-    prefix = prefixes[0]
-    min_suf, max_suf = min(suffixes), max(suffixes)
-    expanded = [f"{prefix}_{i}" for i in range(min_suf, max_suf + 1)]
-    # Sort and return unique
-    return sort_genes(set(expanded))
-
-
 def identify_clusters(
-    sorted_genes: List[str],
+    sorted_genes: List[ParsedGene],
     differential_genes: Set[str],
-    gene_to_edges: Dict[str, Set[int]],
+    gene_edge_masks: Dict[str, int],
     total_edges: int,
     max_gap: int,
     gap_count: int
 ) -> List[Dict[str, Any]]:
     """
     Identify clusters based on adjacency, then expand gaps and validate.
+    sorted_genes are parsed genes as returned by sort_genes; gene_edge_masks maps
+    each gene to the bitmask of pathway edges it covers.
     """
     clusters = []
     current_cluster: List[str] = []
-    differential_count = 0
-    current_edges: Set[int] = set()
     current_gap = 0
+    # Prefix and suffix range of the numbered genes ("<prefix>_<int>") in the current cluster
+    current_prefix = ""
+    current_min_suf: Optional[int] = None
+    current_max_suf: Optional[int] = None
 
     def process_current():
         nonlocal clusters
         if not current_cluster:
             return
-        # Expand cluster to include gap genes
-        expanded = expand_cluster_with_gaps(current_cluster)
-        # Recalculate differential count and edges
-        diff_count_expanded = sum(1 for gene in expanded if gene in differential_genes)
-        edges_expanded: Set[int] = set()
-        for gene in expanded:
-            edges_expanded.update(gene_to_edges.get(gene, set()))
+        # Expand cluster to include gap genes; suffixes grow monotonically, so the
+        # expanded range is already in sorted order
+        if current_min_suf is None:
+            size = len(current_cluster)
+        else:
+            size = current_max_suf - current_min_suf + 1
+        # Single genes never validate, and most cuts leave one behind
+        if size < 2:
+            return
+        if current_min_suf is None:
+            expanded = current_cluster  # replaced, never mutated, after processing
+        else:
+            expanded = [f"{current_prefix}_{i}" for i in range(current_min_suf, current_max_suf + 1)]
+        # Recalculate differential count and edges; expanded genes are distinct
+        diff_count_expanded = len(differential_genes.intersection(expanded))
+        edges_expanded = 0
+        for mask in map(gene_edge_masks.get, expanded):
+            if mask:
+                edges_expanded |= mask
         # Validate expanded cluster
         result = validate_cluster(expanded, diff_count_expanded, edges_expanded, total_edges)
         if result:
             clusters.append(result)
 
-    for gene in sorted_genes:
+    # Differential genes and edges are only counted over the expanded cluster in
+    # process_current, so the loop just tracks membership, gaps and the suffix range
+    for i, (gene, prefix_cur, suffix_cur, numbered) in enumerate(sorted_genes):
         if not current_cluster:
             current_cluster = [gene]
-            differential_count = 1 if gene in differential_genes else 0
-            current_edges = gene_to_edges.get(gene, set()).copy()
             current_gap = 0
+            current_prefix = prefix_cur
+            current_min_suf = current_max_suf = suffix_cur if numbered else None
             continue
 
-        prev = current_cluster[-1]
-        prefix_prev, suffix_prev = prev.rsplit("_", 1) if "_" in prev else (prev, '0')
-        prefix_cur, suffix_cur = gene.rsplit("_", 1) if "_" in gene else (gene, '0')
+        # current_cluster[-1] is always the previous gene in sorted order
+        _, prefix_prev, suffix_prev, _ = sorted_genes[i - 1]
 
         same_prefix = (prefix_prev == prefix_cur)
         gap = 0
-        if same_prefix:
-            try:
-                gap = int(suffix_cur) - int(suffix_prev)
-            except ValueError:
-                gap = 0
+        if same_prefix and suffix_prev is not None and suffix_cur is not None:
+            gap = suffix_cur - suffix_prev
 
-        if same_prefix and gap == 1:
+        if same_prefix and (gap == 1 or (2 <= gap <= max_gap and (gap_count == 1 or current_gap < 1))):
             current_cluster.append(gene)
-            if gene in differential_genes:
-                differential_count += 1
-            current_edges.update(gene_to_edges.get(gene, set()))
-        elif same_prefix and 2 <= gap <= max_gap and (gap_count == 1 or current_gap < 1):
-            current_cluster.append(gene)
-            if gene in differential_genes:
-                differential_count += 1
-            current_edges.update(gene_to_edges.get(gene, set()))
-            current_gap += 1
+            if gap >= 2:
+                current_gap += 1
+            if numbered:
+                if current_min_suf is None:
+                    current_min_suf = suffix_cur
+                current_max_suf = suffix_cur
         else:
             # Process and reset
             process_current()
             current_cluster = [gene]
-            differential_count = 1 if gene in differential_genes else 0
-            current_edges = gene_to_edges.get(gene, set()).copy()
             current_gap = 0
+            current_prefix = prefix_cur
+            current_min_suf = current_max_suf = suffix_cur if numbered else None
 
     # Final cluster
     process_current()
@@ -241,6 +269,68 @@ def identify_clusters(
     return clusters
 
 
+# Read-only state shared with worker processes, set once by _init_worker
+_worker_state: Dict[str, Any] = {}
+
+
+def _init_worker(state: Dict[str, Any]) -> None:
+    _worker_state.update(state)
+
+
+def _process_one_in_worker(item: Tuple[int, List[Dict[str, Any]]]) -> Tuple[int, List[Dict[str, Any]]]:
+    idx, pathway = item
+    return idx, _process_one(idx, pathway, **_worker_state)
+
+
+def _process_one(
+    idx: int,
+    pathway: List[Dict[str, Any]],
+    reaction_to_genes: Dict[str, FrozenSet[str]],
+    activator_genes: Set[str],
+    differential_genes: Set[str],
+    max_gap: int,
+    gap_count: int,
+    edge_gene_cache: Dict[Tuple[str, ...], FrozenSet[str]]
+) -> List[Dict[str, Any]]:
+    """
+    Map a single pathway to its genes and return the valid clusters found for it.
+    edge_gene_cache maps an edge's reaction tuple to its genes and is shared across
+    pathways, since the same reaction sets recur on many edges.
+    """
+    # Edge coverage per gene as a bitmask
+    gene_edge_masks: Dict[str, int] = defaultdict(int)
+
+    for e_idx, edge in enumerate(pathway):
+        edge_bit = 1 << e_idx
+        reactions = tuple(edge.get("diff", ()))
+        edge_genes = edge_gene_cache.get(reactions)
+        if edge_genes is None:
+            edge_genes = frozenset().union(*(reaction_to_genes.get(r, ()) for r in reactions))
+            edge_gene_cache[reactions] = edge_genes
+        for gene in edge_genes:
+            gene_edge_masks[gene] |= edge_bit
+
+    total_edges = len(pathway)
+
+    for gene in activator_genes:
+        gene_edge_masks.setdefault(gene, 0)
+
+    pathway_genes = gene_edge_masks.keys()
+    if not pathway_genes & differential_genes:
+        return []
+
+    logging.info(f"Processing pathway {idx} with {len(pathway_genes)} genes.")
+    sorted_genes = sort_genes(pathway_genes)
+    return identify_clusters(
+        sorted_genes,
+        differential_genes,
+        gene_edge_masks,
+        total_edges,
+        max_gap,
+        gap_count
+    )
+
+
 def process_pathways(
     pathways: List[List[Dict[str, Any]]],
     reaction_to_k: Dict[str, List[str]],
@@ -248,79 +338,97 @@ def process_pathways(
     gene_annotations: Dict[str, str],
     differential_genes: Set[str],
     max_gap: int,
-    gap_count: int
+    gap_count: int,
+    workers: int = 1
 ) -> List[Dict[str, Any]]:
     """
     Process pathways to include activator genes and identify valid clusters.
+    Pathways are independent, so with workers > 1 they are spread over a process pool.
     """
     results = []
     all_k_in_reactions = set(itertools.chain.from_iterable(reaction_to_k.values()))
 
-    for idx, pathway in enumerate(pathways):
-        gene_to_edges: Dict[str, Set[int]] = defaultdict(set)
-        pathway_genes: Set[str] = set()
-
-        for e_idx, edge in enumerate(pathway):
-            for reaction in edge.get("diff", []):
-                for k in reaction_to_k.get(reaction, []):
-                    for gene in k_to_gene.get(k, []):
-                        pathway_genes.add(gene)
-                        gene_to_edges[gene].add(e_idx)
-
-        total_edges = len(pathway)
-
-        for k, genes in k_to_gene.items():
-            if k not in all_k_in_reactions:
-                for gene in genes:
-                    ann = gene_annotations.get(gene, '').lower()
-                    if 'activator' in ann or 'activating' in ann:
-                        if gene not in pathway_genes:
-                            pathway_genes.add(gene)
-                            gene_to_edges[gene] = set()
-
-        if pathway_genes & differential_genes:
-            logging.info(f"Processing pathway {idx} with {len(pathway_genes)} genes.")
-            sorted_genes = sort_genes(pathway_genes)
-            clusters = identify_clusters(
-                sorted_genes,
-                differential_genes,
-                gene_to_edges,
-                total_edges,
-                max_gap,
-                gap_count
-            )
-            if clusters:
-                results.append({"pathway_index": idx, "pathway": pathway, "clusters": clusters})
+    # Activator genes (K numbers outside any reaction) do not depend on the pathway
+    activator_genes: Set[str] = set()
+    for k, genes in k_to_gene.items():
+        if k not in all_k_in_reactions:
+            for gene in genes:
+                ann = gene_annotations.get(gene, '').lower()
+                if 'activator' in ann or 'activating' in ann:
+                    activator_genes.add(gene)
+
+    # Resolve reaction -> K numbers -> genes once, so edges need a single lookup
+    reaction_to_genes: Dict[str, FrozenSet[str]] = {
+        reaction: frozenset().union(*(k_to_gene.get(k, ()) for k in ks))
+        for reaction, ks in reaction_to_k.items()
+    }
+
+    state = {
+        "reaction_to_genes": reaction_to_genes,
+        "activator_genes": activator_genes,
+        "differential_genes": differential_genes,
+        "max_gap": max_gap,
+        "gap_count": gap_count,
+        # Filled lazily; each worker process fills its own copy
+        "edge_gene_cache": {},
+    }
+    if workers > 1 and len(pathways) > 1:
+        chunksize = max(1, len(pathways) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,)) as executor:
+            # map() yields in submission order, so results keep the pathway order
+            found = list(executor.map(_process_one_in_worker, enumerate(pathways), chunksize=chunksize))
+    else:
+        found = [(idx, _process_one(idx, pathway, **state)) for idx, pathway in enumerate(pathways)]
+
+    for idx, clusters in found:
+        if clusters:
+            results.append({"pathway_index": idx, "pathway": pathways[idx], "clusters": clusters})
 
     logging.info(f"Total pathways processed: {len(results)}")
     return results
 
 
-def sort_genes(genes: Set[str]) -> List[str]:
-    """Sort genes by prefix and numeric suffix."""
-    def key_fn(g: str):
-        parts = g.rsplit("_", 1)
-        prefix = parts[0]
-        try:
-            suffix = int(parts[1])
-        except (IndexError, ValueError):
-            suffix = 0
-        return prefix, suffix
-    return sorted(genes, key=key_fn)
+@lru_cache(maxsize=None)
+def parse_gene(gene: str) -> ParsedGene:
+    """
+    Split a gene name into (gene, prefix, numeric suffix, numbered).
+    A non-numeric suffix is None; genes without "_" get suffix 0 but are not numbered.
+    Results are cached since the same genes recur across pathways.
+    """
+    prefix, sep, suffix_str = gene.rpartition("_")
+    if not sep:
+        return gene, gene, 0, False
+    try:
+        return gene, prefix, int(suffix_str), True
+    except ValueError:
+        return gene, prefix, None, False
+
+
+def sort_genes(genes: Set[str]) -> List[ParsedGene]:
+    """Sort genes by prefix and numeric suffix, returning their parsed tuples."""
+    # Decorate each parsed gene with its sort key once, sort, then undecorate
+    keyed = []
+    for g in genes:
+        parsed = parse_gene(g)
+        _, prefix, suffix, _ = parsed
+        keyed.append((prefix, suffix if suffix is not None else 0, g, parsed))
+    keyed.sort()
+    return [parsed for _, _, _, parsed in keyed]
 
 
 def write_output(output_file: str, processed_pathways: List[Dict[str, Any]]) -> None:
     separator = "----------------------------------------"
+    # One encoder for every record; json.dumps builds a new one per call when given options
+    encode = json.JSONEncoder(ensure_ascii=False).encode
     try:
-        with open(output_file, 'w', encoding='utf-8') as file:
+        with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as file:
             for info in processed_pathways:
-                for edge in info["pathway"]:
-                    file.write(json.dumps({"source": edge.get("source"),
-                                           "target": edge.get("target"),
-                                           "diff": edge.get("diff")}, ensure_ascii=False) + "\n")
-                for cl in info["clusters"]:
-                    file.write(json.dumps({"cluster_genes": ", ".join(cl["genes"])}, ensure_ascii=False) + "\n")
-                file.write(separator + "\n")
+                lines = [encode({"source": edge.get("source"),
+                                 "target": edge.get("target"),
+                                 "diff": edge.get("diff")}) for edge in info["pathway"]]
+                lines.extend(encode({"cluster_genes": ", ".join(cl["genes"])}) for cl in info["clusters"])
+                lines.append(separator)
+                file.write("\n".join(lines) + "\n")
         logging.info(f"Output written to {output_file}")
     except Exception as e:
         logging.error(f"Error writing output file: {e}")
@@ -337,6 +445,7 @@ def main():
     parser.add_argument("--max_gap", type=int, default=2, help="Maximum allowable gap between adjacent genes in a cluster."
                              "For example, max_gap=2 allows up to one gene between adjacent genes.default max_gap = 2.")
     parser.add_argument("--gap_count", type=int, choices=[0,1], default=0, help="Set to 1 to allow multiple gaps within a cluster or 0 to allow at most one gap.Default = 0.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes used to analyse pathways. Default = number of CPUs.")
     args = parser.parse_args()
 
     pathways = parse_network(args.network)
@@ -346,7 +455,7 @@ def main():
 
     processed = process_pathways(
         pathways, reaction_to_k, k_to_gene, gene_annotations,
-        differential_genes, args.max_gap, args.gap_count
+        differential_genes, args.max_gap, args.gap_count, args.workers
     )
 
     write_output(args.output, processed)
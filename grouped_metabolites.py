@@ -2,13 +2,18 @@
 import sys
 import re
 from collections import defaultdict
+import numpy as np
+
+# 预编译提取mass数字部分的正则表达式
+_NUM_RE = re.compile(r'(\d+\.?\d*)')
 
 def parse_metabolite(line):
     """解析代谢物字符串，返回retention time和mass"""
-    rt, mass_str = line.strip().split('_')
+    original = line.strip()
+    rt, mass_str = original.split('_')
     # 使用正则表达式提取数字部分作为mass
-    mass = float(re.match(r'(\d+\.?\d*)', mass_str).group(1))
-    return rt, mass, line.strip()
+    mass = float(_NUM_RE.match(mass_str).group(1))
+    return rt, mass, original
 
 def calculate_ppm(mass1, mass2):
     """计算两个质量之间的ppm差异"""
@@ -27,20 +32,21 @@ def group_metabolites(filename, ppm_threshold=10):
     # 按质量排序
     metabolites.sort()
     
-    # 分组
+    # 分组：每组以组内第一个mass为基准，用二分查找直接定位组的结束位置
+    masses = np.array([mass for mass, _ in metabolites], dtype=np.float64)
     groups = defaultdict(list)
-    current_group_mass = None
-    
-    for mass, original in metabolites:
-        if current_group_mass is None:
-            current_group_mass = mass
-            groups[mass].append(original)
-        else:
-            if calculate_ppm(mass, current_group_mass) <= ppm_threshold:
-                groups[current_group_mass].append(original)
-            else:
-                current_group_mass = mass
-                groups[mass].append(original)
+    start = 0
+    n = len(metabolites)
+    while start < n:
+        current_group_mass = metabolites[start][0]
+        end = int(np.searchsorted(masses, current_group_mass * (1 + ppm_threshold / 1e6), side='right'))
+        # 按原ppm公式修正浮点误差造成的边界偏差
+        while end < n and calculate_ppm(metabolites[end][0], current_group_mass) <= ppm_threshold:
+            end += 1
+        while end > start + 1 and calculate_ppm(metabolites[end - 1][0], current_group_mass) > ppm_threshold:
+            end -= 1
+        groups[current_group_mass].extend(original for _, original in metabolites[start:end])
+        start = end
     
     return groups
 
@@ -1,7 +1,5 @@
 import pandas as pd
 import numpy as np
-from collections import deque
-import bisect
 import argparse
 import tqdm
 import sys
@@ -13,43 +11,69 @@ def load_data(adduct_file, central_file, mz_file, diff_file):
 
     # Load central file
     # Central compound masses
-    central_data = pd.read_csv(central_file, header=None, names=['weight'])
-    central_weights = central_data['weight'].tolist()
-
-    # Initialize the ms_data dictionary
-    # Initialize a dictionary to store central compound masses
-    ms_data = {}
-    # Add central.txt data to ms_data
-    # Key: central compound mass, Value: central compound mass
-    for weight in central_weights:
-        key = f"{weight}"
-        ms_data[key] = weight
+    central_weights = np.loadtxt(central_file, dtype=np.float64, ndmin=1).tolist()
 
     # Load mz_file
-    mz_data = pd.read_csv(mz_file, header=None, names=['original_weight'])
-    mz_weights = mz_data['original_weight'].tolist()
+    mz_weights = np.loadtxt(mz_file, dtype=np.float64, ndmin=1).tolist()
     # Generate corresponding adducts for mz_weights using adduct_data
     # Central is fixed, mz +/- adduct
-    for original_weight in mz_weights:
-        for _, row in adduct_data.iterrows():
-            adduct_with_sign = row['adduct']  # "+H" or "-H"
-            mass = row['mass']
-            
-            # Separate the sign and the actual ion name
-            sign = adduct_with_sign[0]   # '+' or '-'
-            ion = adduct_with_sign[1:]
-            
-            if sign == '+':
-                # adjusted_weight = original_weight - mass
-                adjusted_weight = original_weight - mass
-                key = f"{original_weight}+{ion}"
-            else:
-                # If the sign is negative
-                # adjusted_weight = original_weight + mass
-                adjusted_weight = original_weight + mass
-                key = f"{original_weight}-{ion}"
-            
-            ms_data[key] = adjusted_weight
+    adducts = adduct_data['adduct'].tolist()  # "+H" or "-H"
+    # Separate the sign and the actual ion name
+    # '+' adducts: adjusted_weight = original_weight - mass; otherwise original_weight + mass
+    signs = ['+' if adduct[0] == '+' else '-' for adduct in adducts]
+    ions = [adduct[1:] for adduct in adducts]
+    sign_factors = np.array([-1.0 if sign == '+' else 1.0 for sign in signs])
+    masses = adduct_data['mass'].to_numpy(dtype=np.float64)
+
+    # One row per mz weight, one column per adduct, in the same order as the node parts below
+    adjusted_weights = np.asarray(mz_weights, dtype=np.float64)[:, None] + sign_factors * masses
+
+    # Per adduct, the same for every mz weight: the key suffix (sign + ion), and whether the
+    # ion changes how the key splits into its base weight ('-' adduct with '+' in the ion)
+    adduct_parts = [(sign + ion, sign == '-' and '+' in ion) for sign, ion in zip(signs, ions)]
+
+    # Every node is (weight string, key suffix, ion split flag): central masses first, then
+    # mz +/- adduct. Key: weight string + sign + ion, e.g. "118.0635457" or "117.0557+H"
+    node_parts = [(f"{weight}", "", False) for weight in central_weights]
+    mz_strings = [f"{original_weight}" for original_weight in mz_weights]
+    node_parts += [(weight_str, suffix, ion_splits) for weight_str in mz_strings for suffix, ion_splits in adduct_parts]
+    node_weights = central_weights + adjusted_weights.ravel().tolist()
+
+    # Give every node an integer id: keys, weights and base weight ids are parallel by id,
+    # built once here so the search only works with arrays
+    ms_keys = []
+    weights = []
+    key_to_index = {}
+    # Intern base weight strings. Candidates are matched on the part of the key before any
+    # sign, while a visited node records the part before its first adduct sign. Both are
+    # the weight string itself unless the weight string or ion contains a sign character.
+    base_ids = {}
+    candidate_base_ids = []
+    visit_base_ids = []
+    for (weight_str, suffix, ion_splits), weight in zip(node_parts, node_weights):
+        key = weight_str + suffix
+        index = key_to_index.get(key)
+        if index is not None:
+            # A repeated key keeps its first position and takes the latest weight
+            weights[index] = weight
+            continue
+        key_to_index[key] = len(ms_keys)
+        ms_keys.append(key)
+        weights.append(weight)
+
+        candidate_base = visit_base = weight_str
+        if ion_splits or '+' in weight_str or '-' in weight_str:
+            candidate_base = key.split('+')[0].split('-')[0]
+            if '+' in key:
+                visit_base = key.split('+')[0]
+            elif '-' in key:
+                visit_base = key.split('-')[0]
+        candidate_base_ids.append(base_ids.setdefault(candidate_base, len(base_ids)))
+        visit_base_ids.append(base_ids.setdefault(visit_base, len(base_ids)))
+
+    ms_weights = np.array(weights, dtype=np.float64)
+    candidate_base_ids = np.array(candidate_base_ids, dtype=np.int32)
+    visit_base_ids = np.array(visit_base_ids, dtype=np.int32)
 
     # Load diff_file
     # diff_values for target matching, diff_other_values for associated reactions
@@ -57,7 +81,9 @@ def load_data(adduct_file, central_file, mz_file, diff_file):
     diff_values = diff_df['diff_mass'].values
     diff_other_values = diff_df['ENTRY'].values
 
-    return ms_data, (diff_values, diff_other_values)
+    node_data = (ms_keys, ms_weights, key_to_index, candidate_base_ids, visit_base_ids)
+
+    return node_data, (diff_values, diff_other_values)
 
 '''Check if two nodes represent the same molecule (difference < 10ppm)'''
 def is_same_molecule(weight1, weight2, threshold_ppm=10):
@@ -71,7 +97,51 @@ def get_actual_molecule_weight(key, ms_data):
     # For keys with adducts, get their adjusted mass through ms_data
     return ms_data[key]
 
-def find_matches(start_weight, end_weight, ms_data, diff_data, max_depth):
+'''Find the nodes reachable from one node: every node whose weight difference falls
+in a reaction diff range, in ms_data order, with the matching reaction entries'''
+def find_neighbours(current_weight_value, ms_weights, weight_order, sorted_weights, lower_np, upper_np, upper_max_np, bound_entries, diff_tolerance):
+    # Only nodes within the widest diff range of the current weight can match, so take
+    # that window from the sorted weights (with some slack) and restore ms_data order
+    max_diff = (upper_max_np[-1] if len(upper_max_np) else 0.0) + diff_tolerance
+    window = np.sort(weight_order[np.searchsorted(sorted_weights, current_weight_value - max_diff, side='left'):
+                                  np.searchsorted(sorted_weights, current_weight_value + max_diff, side='right')])
+    diffs = np.abs(ms_weights[window] - current_weight_value)
+    # Ranges are sorted by lower bound. A range can only contain diff_ms if its lower
+    # bound lies in [diff_ms - 2*tolerance, diff_ms]; the scan also checks the range
+    # just below that window, so start one position lower.
+    stop = np.searchsorted(lower_np, diffs, side='right')
+    start = np.maximum(np.searchsorted(lower_np, diffs - 2*diff_tolerance, side='left') - 1, 0)
+    # upper_max_np is the running maximum of the upper bounds, so every range before
+    # this position ends below diff_ms; skip them
+    start = np.maximum(start, np.minimum(np.searchsorted(upper_max_np, diffs, side='left'), stop))
+    counts = stop - start
+    in_window = np.nonzero(counts)[0]
+    candidates = window[in_window]
+    counts = counts[in_window]
+    # Lay every candidate's ranges out in one flat array, highest lower bound first,
+    # and test them all against the candidate's diff at once
+    owner = np.repeat(np.arange(len(candidates)), counts)
+    offsets = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    bounds = np.repeat(stop[in_window] - 1, counts) - offsets
+    diff_ms = diffs[in_window][owner]
+    hit = (diff_ms >= lower_np[bounds]) & (diff_ms <= upper_np[bounds])
+    owner = owner[hit]
+    bounds = bounds[hit]
+    if not len(owner):
+        return candidates[:0], []
+    neighbour_indices = candidates[np.unique(owner)]
+    neighbour_diffs = []
+    for group in np.split(bounds, np.flatnonzero(np.diff(owner)) + 1):
+        if len(group) == 1:
+            neighbour_diffs.append(bound_entries[group[0]])
+        else:
+            neighbour_diffs.append([entry for b in group for entry in bound_entries[b]])
+    return neighbour_indices, neighbour_diffs
+
+'''Search paths from the start weight to the end weight, writing each path to out_file
+as soon as it is found. Returns the number of paths written'''
+def find_matches(start_weight, end_weight, node_data, diff_data, max_depth, out_file):
+    ms_keys, ms_weights, key_to_index, candidate_base_ids, visit_base_ids = node_data
     diff_values, diff_other_values = diff_data
 
     '''Pre-calculate and cache all possible difference matches'''
@@ -89,128 +159,171 @@ def find_matches(start_weight, end_weight, ms_data, diff_data, max_depth):
     
     # Sort the boundaries for binary search
     sorted_bounds.sort(key=lambda x: x[0])  # Sort by lower bound
-    lower_bounds = [bound[0] for bound in sorted_bounds]
-    upper_bounds = [bound[1] for bound in sorted_bounds]
-    
-    queue = deque([(f"{start_weight}", 0, [], set(), set())])  # Initialize queue, add a set to store actual molecule weights
-    results = []
+    lower_np = np.array([bound[0] for bound in sorted_bounds], dtype=np.float64)
+    upper_np = np.array([bound[1] for bound in sorted_bounds], dtype=np.float64)
+    upper_max_np = np.maximum.accumulate(upper_np)
+    bound_entries = [diff_mapping[bound] for bound in sorted_bounds]
+    # Node ids sorted by weight, for taking the window of nodes near a weight
+    weight_order = np.argsort(ms_weights, kind='stable')
+    sorted_weights = ms_weights[weight_order]
 
-    # Split the keys of ms_data and convert them to a numpy array of strings
-    ms_keys = np.array(list(ms_data.keys()))
-    ms_weights = np.array(list(ms_data.values()))
+    # Whether each node is within 20ppm of the end weight
+    reaches_end = np.abs(ms_weights - end_weight) / ms_weights * 1e6 < 20
+
+    # Neighbours only depend on the node, so compute them on first visit and reuse them.
+    # Their indices are also kept in one flat array, with each node's start and count.
+    # The output line of each edge (the step dict as text) is built once and shared by
+    # all paths that use it.
+    neighbour_steps = [None] * len(ms_keys)
+    neighbour_chunks = []
+    neighbour_flat = np.empty(0, dtype=np.intp)
+    neighbour_start = np.zeros(len(ms_keys), dtype=np.intp)
+    neighbour_count = np.zeros(len(ms_keys), dtype=np.intp)
+    flat_len = 0
+    # Whether a node's neighbours have been computed yet
+    has_neighbours = np.zeros(len(ms_keys), dtype=bool)
+    # Whether any neighbour of a node is within 20ppm of the end weight
+    leads_to_end = np.zeros(len(ms_keys), dtype=bool)
+
+    # Search one depth at a time. Every path in the frontier has the same length, so the
+    # base ids and weights along the paths are kept as one contiguous array per path
+    # position, with one entry per path. Processing each level in order visits paths in
+    # the same order as a FIFO queue would.
+    # The per-depth parents and positions are kept for the whole search, so they are
+    # stored as int32; the current frontier stays in native index arrays for fast gathers.
+    # The node ids along a path are not stored: they are found again from the start node
+    # and the positions when a path is accepted.
+    start_node = key_to_index[f"{start_weight}"]
+    frontier_nodes = np.array([start_node], dtype=np.intp)
+    frontier_bases = [visit_base_ids[frontier_nodes]]
+    frontier_weights = [ms_weights[frontier_nodes]]
+    # Per depth: the parent path at the previous depth, and the position of the last
+    # step in the parent node's neighbour list (for looking up its reaction entries)
+    level_parent = [None]
+    level_pos = [None]
+    # Bound the number of candidates checked at once to keep the temporary arrays small
+    block_candidates = 1 << 19
+
+    def add_neighbours(nodes):
+        '''Compute the neighbours of the nodes that are visited for the first time'''
+        nonlocal neighbour_flat, flat_len
+        new_nodes = np.unique(nodes[~has_neighbours[nodes]]).tolist()
+        for node in new_nodes:
+            node_neighbours, node_diffs = find_neighbours(
+                ms_weights[node], ms_weights, weight_order, sorted_weights, lower_np, upper_np, upper_max_np, bound_entries, diff_tolerance
+            )
+            neighbour_steps[node] = [str({'source': ms_keys[node], 'target': ms_keys[target], 'diff': diff})
+                                     for target, diff in zip(node_neighbours.tolist(), node_diffs)]
+            neighbour_start[node] = flat_len
+            neighbour_count[node] = len(node_neighbours)
+            flat_len += neighbour_count[node]
+            neighbour_chunks.append(node_neighbours)
+            leads_to_end[node] = reaches_end[node_neighbours].any()
+            has_neighbours[node] = True
+        if new_nodes:
+            neighbour_flat = np.concatenate(neighbour_chunks)
+
+    def build_paths(depth, path_index, pos):
+        '''Collect the step lines of accepted paths, walking back to the start for all of them at once'''
+        positions = np.empty((len(path_index), depth + 1), dtype=np.intp)
+        positions[:, depth] = pos
+        for level in range(depth, 0, -1):
+            positions[:, level - 1] = level_pos[level][path_index]
+            path_index = level_parent[level][path_index]
+        # Follow the positions forward from the start node to recover the nodes
+        nodes = np.empty_like(positions)
+        node = np.full(len(positions), start_node, dtype=np.intp)
+        for level in range(depth + 1):
+            nodes[:, level] = node
+            node = neighbour_flat[neighbour_start[node] + positions[:, level]]
+        nodes = nodes.tolist()
+        return ['\n'.join([neighbour_steps[node][p] for node, p in zip(path_nodes, path_positions)])
+                for path_nodes, path_positions in zip(nodes, positions.tolist())]
 
-    candidate_base_weights = np.array([k.split('+')[0].split('-')[0] for k in ms_keys])
-    
     # Create progress bar, set to dynamic mode
     pbar = tqdm.tqdm(dynamic_ncols=True, desc="Search Progress", leave=True)
-    
+
     processed_nodes = 0
-    update_interval = 100  # Update progress bar every 100 nodes
-    max_queue_len = len(queue)
+    max_queue_len = len(frontier_nodes)
     found_paths = 0
-    
-    while queue:
-        # Update maximum queue length
-        max_queue_len = max(max_queue_len, len(queue))
-        
-        current_key, current_depth, path, used_nodes, used_molecules = queue.popleft()
-        processed_nodes += 1
-        
-        # Periodically update progress bar
-        if processed_nodes % update_interval == 0:
-            pbar.set_postfix({
-                'Processed': processed_nodes, 
-                'Queue Size': len(queue), 
-                'Max Queue': max_queue_len, 
-                'Paths Found': found_paths
-            })
-            pbar.update(update_interval)
-
-        if current_depth >= max_depth:
-            continue
 
-        # Extract the base weight of the current node
-        if '+' in current_key:
-            base_weight = current_key.split('+')[0]
-        elif '-' in current_key:
-            base_weight = current_key.split('-')[0]
+    for current_depth in range(max_depth):
+        if not len(frontier_nodes):
+            break
+        max_queue_len = max(max_queue_len, len(frontier_nodes))
+
+        add_neighbours(frontier_nodes)
+
+        expand = current_depth + 1 < max_depth
+        counts = neighbour_count[frontier_nodes]
+        ends = np.cumsum(counts)
+        next_parent = []
+        next_pos = []
+        next_nodes = []
+        block_start = 0
+        while block_start < len(frontier_nodes):
+            before = ends[block_start] - counts[block_start]
+            block_end = max(int(np.searchsorted(ends, before + block_candidates, side='right')), block_start + 1)
+            block_counts = counts[block_start:block_end]
+            # One row per (path, neighbour of its last node) pair, in queue order
+            path_of = np.repeat(np.arange(block_start, block_end), block_counts)
+            pos = np.arange(len(path_of)) - np.repeat(ends[block_start:block_end] - block_counts - before, block_counts)
+            candidates = neighbour_flat[neighbour_start[frontier_nodes[path_of]] + pos]
+            candidate_bases = candidate_base_ids[candidates]
+            candidate_weights = ms_weights[candidates]
+
+            # Compare against the path one position at a time, on flat arrays
+            reject = np.zeros(len(candidates), dtype=bool)
+            for bases, weights in zip(frontier_bases, frontier_weights):
+                # Exclude used base weights
+                reject |= bases[path_of] == candidate_bases
+                '''Check if the new node's actual weight has already appeared in the path (within 10ppm tolerance)'''
+                reject |= is_same_molecule(candidate_weights, weights[path_of])
+            keep = ~reject
+            path_of, pos, candidates = path_of[keep], pos[keep], candidates[keep]
+
+            # check 20ppm
+            hit = reaches_end[candidates]
+            if hit.any():
+                # One line per step, then a separator line between paths; written per block
+                separator = '\n' + "-" * 40 + '\n'
+                out_file.write(separator.join(build_paths(current_depth, path_of[hit], pos[hit])) + separator)
+            found_paths += int(hit.sum())
+            if expand:
+                next_parent.append(path_of[~hit].astype(np.int32))
+                next_pos.append(pos[~hit].astype(np.int32))
+                next_nodes.append(candidates[~hit])
+            block_start = block_end
+
+        processed_nodes += len(frontier_nodes)
+        if expand and next_nodes:
+            parent = np.concatenate(next_parent)
+            frontier_nodes = np.concatenate(next_nodes)
+            next_pos = np.concatenate(next_pos)
+            if current_depth + 2 == max_depth:
+                # Paths at the last depth are only kept if they step onto the end weight, so
+                # drop the ones whose last node has no neighbour near it before expanding them
+                add_neighbours(frontier_nodes)
+                alive = leads_to_end[frontier_nodes]
+                parent, frontier_nodes, next_pos = parent[alive], frontier_nodes[alive], next_pos[alive]
+            frontier_bases = [bases[parent] for bases in frontier_bases] + [visit_base_ids[frontier_nodes]]
+            frontier_weights = [weights[parent] for weights in frontier_weights] + [ms_weights[frontier_nodes]]
+            level_parent.append(parent)
+            level_pos.append(next_pos)
         else:
-            base_weight = current_key
-
-        # Copy the set of used nodes to prevent sharing between paths
-        used_nodes = used_nodes.copy()
-        used_nodes.add(base_weight)
-
-        current_weight_value = ms_data[current_key]
-        '''Copy the set of used actual molecule weights'''
-        used_molecules = used_molecules.copy()
-        used_molecules.add(current_weight_value)
-
-        # Exclude used base weights
-        used_mask = np.isin(candidate_base_weights, list(used_nodes))
-        valid_indices = np.where(~used_mask)[0]
-
-        # Get valid candidate node information
-        valid_weights = ms_weights[valid_indices]
-        valid_keys = ms_keys[valid_indices]
-
-        diffs = np.abs(valid_weights - current_weight_value)
-
-        for i in range(len(valid_indices)):
-            diff_ms = diffs[i]
-            key = valid_keys[i]
-            weight = valid_weights[i]
-
-            '''Check if this new node's actual weight has already appeared in the path (within 10ppm tolerance)'''
-            is_duplicate = False
-            for used_mol_weight in used_molecules:
-                if is_same_molecule(weight, used_mol_weight):
-                    is_duplicate = True
-                    break
-            if is_duplicate:
-                continue
-
-            # Check if the difference is close to any value in diff mass
-            diff_subset = []
-            # Accelerate retrieval with binary search
-            pos = bisect.bisect_right(lower_bounds, diff_ms)
-            # Check ranges to the left
-            for j in range(pos-1, -1, -1):
-                if diff_ms >= lower_bounds[j] and diff_ms <= upper_bounds[j]:
-                    diff_subset.extend(diff_mapping[(lower_bounds[j], upper_bounds[j])])
-                # If current lower bound is too small, stop searching left
-                if lower_bounds[j] < diff_ms - 2*diff_tolerance:
-                    break
-            # Check ranges to the right
-            for j in range(pos, len(sorted_bounds)):
-                if diff_ms >= lower_bounds[j] and diff_ms <= upper_bounds[j]:
-                    diff_subset.extend(diff_mapping[(lower_bounds[j], upper_bounds[j])])
-                # If current lower bound is too large, stop searching right
-                if lower_bounds[j] > diff_ms + 2*diff_tolerance:
-                    break
-            if diff_subset:
-                new_step = {'source': str(current_key), 'target': str(key), 'diff': diff_subset}
-                new_path = path + [new_step]
-
-                # check 20ppm
-                if abs(weight - end_weight) / weight * 1e6 < 20:
-                    results.append(new_path)
-                    found_paths += 1
-                else:
-                    if current_depth + 1 < max_depth:
-                        queue.append((key, current_depth + 1, new_path, used_nodes, used_molecules))
-    
-    # Update final progress
-    pbar.set_postfix({
-        'Processed': processed_nodes, 
-        'Queue Size': len(queue), 
-        'Max Queue': max_queue_len, 
-        'Paths Found': found_paths
-    })
-    pbar.update(processed_nodes % update_interval)
+            frontier_nodes = frontier_nodes[:0]
+
+        pbar.set_postfix({
+            'Processed': processed_nodes,
+            'Queue Size': len(frontier_nodes),
+            'Max Queue': max_queue_len,
+            'Paths Found': found_paths
+        })
+        pbar.update(processed_nodes - pbar.n)
+
     pbar.close()
     
-    return results
+    return found_paths
 
 def main():
     parser = argparse.ArgumentParser(description="Analyze metabolic networks from mass spectrometry data.")
@@ -226,19 +339,14 @@ def main():
     args = parser.parse_args()
 
     print(f"Loading data files...")
-    ms_data, diff_data = load_data(args.adduct_file, args.central_file, args.mz_file, args.diff_file)
+    node_data, diff_data = load_data(args.adduct_file, args.central_file, args.mz_file, args.diff_file)
     print(f"Data loading complete, starting path search...")
     
-    paths = find_matches(args.start_weight, args.end_weight, ms_data, diff_data, args.max_depth)
-    
-    print(f"Found {len(paths)} paths, writing to {args.output}...")
-    with open(args.output, 'w') as f:
-        for path in paths:
-            for step in path:
-                f.write(str(step) + '\n')
-            f.write("-" * 40 + '\n')  # Separator line between paths
+    # Paths are written to the output file while the search runs
+    with open(args.output, 'w', buffering=1 << 20) as f:
+        path_count = find_matches(args.start_weight, args.end_weight, node_data, diff_data, args.max_depth, f)
     
-    print(f"Successfully wrote {len(paths)} paths to {args.output}")
+    print(f"Successfully wrote {path_count} paths to {args.output}")
 
 if __name__ == '__main__':
     main()
@@ -11,58 +11,44 @@ def update_kegg_annotation(renamed_genes_file, kegg_file, output_file):
         kegg_file: Path to the original KEGG annotation file
         output_file: Path to the output file with updated KEGG annotations
     """
-    # Create mapping from original gene IDs to new gene IDs
-    id_mapping = {}
-    
     # Read the renamed genes file
-    with open(renamed_genes_file, 'r') as f:
+    with open(renamed_genes_file, 'r', buffering=1 << 20) as f:
         # Skip header
         header = f.readline()
         
-        # Read each line
-        for line in f:
-            fields = line.strip().split('\t')
-            if len(fields) >= 2:
-                new_id = fields[0]  # contig_1, contig_2, ...
-                original_id = fields[1]  # MRS000001, MRS000002, ...
-                
-                # Build the mapping relationship
-                id_mapping[original_id] = new_id
+        # Only the first two columns are needed, so leave the coordinates unsplit
+        rows = (line.strip().split('\t', 2) for line in f)
+        # Create mapping from original gene IDs (MRS000001, ...) to new gene IDs (contig_1, ...)
+        id_mapping = {fields[1]: fields[0] for fields in rows if len(fields) >= 2}
     
-    # Read KEGG annotation file and update gene IDs
-    updated_annotations = []
-    not_found = []
+    # Read KEGG annotation file and write the updated gene IDs as we go
+    count = 0
+    not_found = 0
+    not_found_examples = []
     
-    with open(kegg_file, 'r') as f:
+    with open(kegg_file, 'r', buffering=1 << 20) as f, open(output_file, 'w', buffering=1 << 20) as out:
         for line in f:
-            fields = line.strip().split('\t')
-            if len(fields) >= 2:
-                original_id = fields[0]  # Original gene ID
-                kegg_id = fields[1]      # KEGG ID
-                
+            # Only the first column is replaced, so split it off and keep the rest as is
+            original_id, sep, rest = line.strip().partition('\t')  # Original gene ID
+            if sep:
                 # Find corresponding new gene ID
-                if original_id in id_mapping:
-                    new_id = id_mapping[original_id]
-                    # Preserve all original columns, only replace the first column ID
-                    updated_fields = [new_id] + fields[1:]
-                    updated_annotations.append(updated_fields)
-                else:
-                    # Record genes without mapping
-                    not_found.append(original_id)
-                    # Keep original ID and all columns
-                    updated_annotations.append(fields)
-    
-    # Write updated annotations to output file
-    with open(output_file, 'w') as out:
-        for fields in updated_annotations:
-            out.write("\t".join(fields) + "\n")
+                new_id = id_mapping.get(original_id)
+                if new_id is None:
+                    # Record genes without mapping, keeping original ID and all columns
+                    new_id = original_id
+                    not_found += 1
+                    if len(not_found_examples) < 5:
+                        not_found_examples.append(original_id)
+                # Preserve all original columns, only replace the first column ID
+                out.write(new_id + "\t" + rest + "\n")
+                count += 1
     
     # Print processing results
-    print(f"Annotation file update completed, processed {len(updated_annotations)} annotation records")
+    print(f"Annotation file update completed, processed {count} annotation records")
     if not_found:
-        print(f"Warning: {len(not_found)} genes were not found in the renaming file")
-        print("Genes without mapping: " + ", ".join(not_found[:5]) + 
-              ("..." if len(not_found) > 5 else ""))
+        print(f"Warning: {not_found} genes were not found in the renaming file")
+        print("Genes without mapping: " + ", ".join(not_found_examples) + 
+              ("..." if not_found > 5 else ""))
     print(f"Updated annotations saved to {output_file}")
 
 if __name__ == "__main__":